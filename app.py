@@ -1,12 +1,13 @@
-from flask import Flask, render_template, jsonify, request, send_file
+from flask import Flask, Response, render_template, jsonify, request, send_file
 from flask_cors import CORS
 import os
 import json
-import io
 import threading
+import time
 import logging
-from immich_cleaner import ImmichCleaner
+from immich_cleaner import ImmichCleaner, HTTP_POOL_SIZE
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 
 app = Flask(__name__)
@@ -16,9 +17,39 @@ CORS(app)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# How long browsers may reuse a proxied thumbnail without asking again
+THUMBNAIL_CACHE_SECONDS = 3600
+
+# Bytes relayed per chunk when streaming a proxied image
+PROXY_CHUNK_SIZE = 64 * 1024
+
+# Shared session so the connection test and thumbnail proxy calls to
+# Immich reuse kept-alive connections instead of a new handshake each time
+immich_session = requests.Session()
+immich_adapter = HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE)
+immich_session.mount('http://', immich_adapter)
+immich_session.mount('https://', immich_adapter)
+
+# Feedback log, one JSON object per line; the old JSON-array file is converted once
+FEEDBACK_FILE = '/data/feedback_log.jsonl'
+LEGACY_FEEDBACK_FILE = '/data/feedback_log.json'
+
+# Thumbnail URLs across Immich API versions, in the order they are tried
+THUMBNAIL_ENDPOINTS = [
+    "{immich_url}/api/asset/thumbnail/{asset_id}?size=preview",
+    "{immich_url}/api/assets/{asset_id}/thumbnail?size=preview",
+    "{immich_url}/api/asset/thumbnail/{asset_id}",
+    "{immich_url}/api/asset/file/{asset_id}?isThumb=true"
+]
+
 # Global variables
 cleaner_engine = None
+thumbnail_endpoint = None
+delete_endpoint = None  # bulk delete path that last succeeded
 analysis_thread = None
+analysis_started_at = None  # time.monotonic() when the current run began
+status_lock = threading.Lock()  # keeps progress/total/found_count consistent for pollers
+feedback_lock = threading.Lock()  # serializes the one-time conversion with appends
 analysis_status = {
     'running': False,
     'progress': 0,
@@ -55,7 +86,7 @@ def save_config():
             'Content-Type': 'application/json'
         }
         # Use the correct endpoint for the user's Immich version
-        response = requests.post(
+        response = immich_session.post(
             f"{immich_url}/api/search/metadata",
             headers=headers,
             json={},
@@ -89,13 +120,7 @@ def save_config():
 @app.route('/api/analyze/start', methods=['POST'])
 def start_analysis():
     """Start the analysis process - FIXED ENDPOINT"""
-    global analysis_thread, analysis_status, cleaner_engine
-    
-    if analysis_status['running']:
-        return jsonify({
-            'success': False,
-            'message': 'Analysis already in progress'
-        }), 400
+    global analysis_thread, analysis_status, analysis_started_at, cleaner_engine
     
     if not cleaner_engine:
         return jsonify({
@@ -103,15 +128,30 @@ def start_analysis():
             'message': 'Please configure Immich connection first'
         }), 400
     
-    # Reset status
-    analysis_status = {
-        'running': True,
-        'progress': 0,
-        'total': 0,
-        'current_file': '',
-        'start_time': datetime.now(),
-        'found_count': 0
-    }
+    # Check and reset in one step so two requests cannot both start a run
+    with status_lock:
+        if analysis_status['running']:
+            return jsonify({
+                'success': False,
+                'message': 'Analysis already in progress'
+            }), 400
+        
+        # A stopped run finishes its current page before exiting; wait for it
+        if analysis_thread and analysis_thread.is_alive():
+            return jsonify({
+                'success': False,
+                'message': 'Previous analysis is still stopping, try again shortly'
+            }), 400
+        
+        analysis_started_at = time.monotonic()
+        analysis_status = {
+            'running': True,
+            'progress': 0,
+            'total': 0,
+            'current_file': '',
+            'start_time': datetime.now(),
+            'found_count': 0
+        }
     
     # Start analysis in background thread
     analysis_thread = threading.Thread(target=run_analysis)
@@ -127,13 +167,14 @@ def stop_analysis():
     """Stop the analysis process"""
     global analysis_status
     
-    if not analysis_status['running']:
-        return jsonify({
-            'success': False,
-            'message': 'No analysis in progress'
-        }), 400
-    
-    analysis_status['running'] = False
+    with status_lock:
+        if not analysis_status['running']:
+            return jsonify({
+                'success': False,
+                'message': 'No analysis in progress'
+            }), 400
+        
+        analysis_status['running'] = False
     
     return jsonify({
         'success': True,
@@ -143,14 +184,15 @@ def stop_analysis():
 @app.route('/api/analyze/status', methods=['GET'])
 def get_analysis_status():
     """Get current analysis status"""
-    status = analysis_status.copy()
+    with status_lock:
+        status = analysis_status.copy()
     
     if status['start_time']:
-        elapsed = (datetime.now() - status['start_time']).total_seconds()
+        elapsed = time.monotonic() - analysis_started_at
         status['elapsed_time'] = int(elapsed)
         
         # Estimate remaining time
-        if status['progress'] > 0:
+        if status['progress'] > 0 and elapsed > 0:
             rate = status['progress'] / elapsed
             remaining = (status['total'] - status['progress']) / rate if rate > 0 else 0
             status['estimated_remaining'] = int(remaining)
@@ -168,7 +210,10 @@ def get_results():
         })
     
     try:
-        results = cleaner_engine.get_results()
+        # Optional paging (?limit=&offset=) applies to each category; omitted means everything
+        limit = request.args.get('limit', type=int)
+        offset = request.args.get('offset', 0, type=int)
+        results = cleaner_engine.get_results(limit=limit, offset=offset)
         return jsonify(results)
     except Exception as e:
         logger.error(f"Error getting results: {e}")
@@ -240,17 +285,27 @@ def export_csv():
         }), 400
     
     try:
-        csv_path = cleaner_engine.export_to_csv()
-        return send_file(csv_path, as_attachment=True, download_name='immich_cleanup_results.csv')
+        csv_file = cleaner_engine.export_to_csv()
+        return send_file(csv_file, mimetype='text/csv', as_attachment=True,
+                         download_name='immich_cleanup_results.csv')
     except Exception as e:
         return jsonify({
             'success': False,
             'message': str(e)
         }), 500
 
+def stream_upstream(response):
+    """Yield an upstream response body in chunks, releasing its connection afterwards"""
+    try:
+        yield from response.iter_content(chunk_size=PROXY_CHUNK_SIZE)
+    finally:
+        response.close()
+
 @app.route('/api/proxy/thumbnail/<asset_id>')
 def proxy_thumbnail(asset_id):
     """Proxy endpoint to fetch Immich thumbnails"""
+    global thumbnail_endpoint
+    
     try:
         immich_url = os.getenv('IMMICH_URL', '')
         api_key = os.getenv('IMMICH_API_KEY', '')
@@ -258,29 +313,33 @@ def proxy_thumbnail(asset_id):
         if not immich_url or not api_key:
             return jsonify({'error': 'Not configured'}), 500
         
-        # Try different Immich endpoints
-        endpoints = [
-            f"{immich_url}/api/asset/thumbnail/{asset_id}?size=preview",
-            f"{immich_url}/api/assets/{asset_id}/thumbnail?size=preview",
-            f"{immich_url}/api/asset/thumbnail/{asset_id}",
-            f"{immich_url}/api/asset/file/{asset_id}?isThumb=true"
-        ]
+        # Try the endpoint that worked last time first, then the rest
+        templates = THUMBNAIL_ENDPOINTS
+        if thumbnail_endpoint:
+            templates = [thumbnail_endpoint] + [t for t in THUMBNAIL_ENDPOINTS if t != thumbnail_endpoint]
         
         headers = {
             'X-Api-Key': api_key,
             'Accept': 'image/*'
         }
         
-        for endpoint in endpoints:
+        for template in templates:
+            endpoint = template.format(immich_url=immich_url, asset_id=asset_id)
             try:
-                response = requests.get(endpoint, headers=headers, timeout=10)
+                response = immich_session.get(endpoint, headers=headers, timeout=10, stream=True)
                 if response.status_code == 200:
-                    # Return the image with proper headers
-                    return send_file(
-                        io.BytesIO(response.content),
+                    thumbnail_endpoint = template
+                    
+                    # Relay the image in chunks rather than buffering it whole
+                    proxied = Response(
+                        stream_upstream(response),
                         mimetype=response.headers.get('Content-Type', 'image/jpeg'),
-                        as_attachment=False
+                        direct_passthrough=True
                     )
+                    proxied.cache_control.private = True
+                    proxied.cache_control.max_age = THUMBNAIL_CACHE_SECONDS
+                    return proxied
+                response.close()
             except Exception as e:
                 logger.debug(f"Endpoint {endpoint} failed: {e}")
                 continue
@@ -295,6 +354,8 @@ def proxy_thumbnail(asset_id):
 @app.route('/api/delete', methods=['POST'])
 def delete_assets():
     """Delete assets directly via Immich API"""
+    global delete_endpoint
+    
     if not cleaner_engine:
         return jsonify({
             'success': False,
@@ -312,34 +373,33 @@ def delete_assets():
     
     try:
         # Delete via Immich API - try different endpoints
-        headers = {
-            'X-Api-Key': cleaner_engine.api_key,
-            'Content-Type': 'application/json'
-        }
-        
         # Try the newer bulk delete endpoint first
         delete_data = {
             "ids": asset_ids,
             "force": True
         }
         
-        # Try different Immich API endpoints
+        # Try different Immich API endpoints, the one that worked last time first
         endpoints = [
             f"{cleaner_engine.base_url}/api/assets",
             f"{cleaner_engine.base_url}/api/asset"
         ]
+        if delete_endpoint in endpoints:
+            endpoints.remove(delete_endpoint)
+            endpoints.insert(0, delete_endpoint)
         
         delete_success = False
         for endpoint in endpoints:
             try:
-                delete_response = requests.delete(
+                # The engine's session already carries the API key headers
+                delete_response = cleaner_engine.session.delete(
                     endpoint,
-                    headers=headers,
                     json=delete_data,
                     timeout=30
                 )
                 
                 if delete_response.status_code in [200, 204]:
+                    delete_endpoint = endpoint
                     delete_success = True
                     break
                 else:
@@ -375,30 +435,44 @@ def save_feedback():
     """Save user feedback for learning"""
     data = request.json
     
-    # Log feedback to a file for future improvements
-    feedback_file = '/data/feedback_log.json'
-    
+    # Log feedback to a file for future improvements, one JSON object per
+    # line so each entry is a single append rather than a full rewrite
     try:
-        # Load existing feedback
-        if os.path.exists(feedback_file):
-            with open(feedback_file, 'r') as f:
-                feedback_data = json.load(f)
-        else:
-            feedback_data = []
-        
-        # Add new feedback
-        feedback_data.append(data)
-        
-        # Save updated feedback
-        os.makedirs(os.path.dirname(feedback_file), exist_ok=True)
-        with open(feedback_file, 'w') as f:
-            json.dump(feedback_data, f, indent=2)
+        with feedback_lock:
+            os.makedirs(os.path.dirname(FEEDBACK_FILE), exist_ok=True)
+            if not os.path.exists(FEEDBACK_FILE):
+                convert_legacy_feedback()
+            
+            with open(FEEDBACK_FILE, 'a') as f:
+                f.write(json.dumps(data) + '\n')
         
         return jsonify({'success': True})
     except Exception as e:
         logger.error(f"Error saving feedback: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def convert_legacy_feedback():
+    """Carry entries from the old feedback_log.json array over to the JSON Lines log"""
+    if not os.path.exists(LEGACY_FEEDBACK_FILE):
+        return
+    
+    try:
+        with open(LEGACY_FEEDBACK_FILE, 'r') as f:
+            entries = json.load(f)
+    except ValueError as e:
+        # An unreadable old log must not block new feedback; it stays on disk as is
+        logger.warning(f"Could not convert {LEGACY_FEEDBACK_FILE}: {e}")
+        return
+    
+    # Written aside and renamed into place so a failure never leaves a partial log;
+    # the old file itself is left untouched
+    temp_file = FEEDBACK_FILE + '.tmp'
+    with open(temp_file, 'w') as f:
+        f.writelines(json.dumps(entry) + '\n' for entry in entries)
+    os.replace(temp_file, FEEDBACK_FILE)
+    
+    logger.info(f"Converted {len(entries)} feedback entries from {LEGACY_FEEDBACK_FILE}")
+
 @app.route('/api/export/deletion_script', methods=['GET'])
 def export_deletion_script():
     """Export deletion script"""
@@ -409,8 +483,9 @@ def export_deletion_script():
         }), 400
     
     try:
-        script_path = cleaner_engine.generate_deletion_script()
-        return send_file(script_path, as_attachment=True, download_name='delete_assets.sh')
+        script_file = cleaner_engine.generate_deletion_script()
+        return send_file(script_file, mimetype='application/x-sh', as_attachment=True,
+                         download_name='delete_assets.sh')
     except Exception as e:
         return jsonify({
             'success': False,
@@ -429,86 +504,74 @@ def run_analysis():
     try:
         logger.info("Starting analysis...")
         
-        # Get total count first
-        headers = {
-            'X-Api-Key': cleaner_engine.api_key,
-            'Content-Type': 'application/json'
-        }
+        # Asset ids processed during this run, checked in memory
+        analyzed_ids = set()
         
-        # Get first page to determine total
-        response = requests.post(
-            f"{cleaner_engine.base_url}/api/search/metadata",
-            headers=headers,
-            json={},
-            timeout=30
-        )
+        # One cheap count up front gives the UI a real total instead of a guess
+        library_total = cleaner_engine.count_assets()
         
-        if response.status_code == 200:
-            data = response.json()
-            # Handle the response structure: data.assets.items
-            if 'assets' in data and 'items' in data['assets']:
-                first_batch = data['assets']['items']
-                # Estimate total (this is approximate, we'll update as we go)
-                analysis_status['total'] = len(first_batch) * 1000  # Rough estimate
-                
-                # Process first batch
-                for idx, asset in enumerate(first_batch):
-                    if not analysis_status['running']:
-                        break
-                    
-                    analysis_status['current_file'] = asset.get('originalFileName', 'Unknown')
-                    analysis_status['progress'] = idx + 1
-                    
-                    # Analyze asset
-                    if cleaner_engine.analyze_asset(asset):
-                        analysis_status['found_count'] += 1
-                
-                # Continue with pagination if available
-                next_page = data['assets'].get('nextPage')
-                page_count = 1
-                
-                while next_page and analysis_status['running']:
-                    response = requests.post(
-                        f"{cleaner_engine.base_url}/api/search/metadata",
-                        headers=headers,
-                        json={'page': next_page},
-                        timeout=30
-                    )
-                    
-                    if response.status_code == 200:
-                        data = response.json()
-                        if 'assets' in data and 'items' in data['assets']:
-                            batch = data['assets']['items']
-                            
-                            for idx, asset in enumerate(batch):
-                                if not analysis_status['running']:
-                                    break
-                                
-                                analysis_status['current_file'] = asset.get('originalFileName', 'Unknown')
-                                analysis_status['progress'] += 1
-                                
-                                # Analyze asset
-                                if cleaner_engine.analyze_asset(asset):
-                                    analysis_status['found_count'] += 1
-                            
-                            next_page = data['assets'].get('nextPage')
-                            page_count += 1
-                            
-                            # Update total estimate
-                            analysis_status['total'] = analysis_status['progress'] + (len(batch) * 10)
-                        else:
-                            break
-                    else:
-                        logger.error(f"Error fetching page {page_count}: {response.status_code}")
-                        break
+        # Scan id and completion belong to this run alone, not to the shared engine
+        scan = cleaner_engine.start_scan()
+        
+        for batch in cleaner_engine.iter_asset_pages(scan):
+            with status_lock:
+                stopped = not analysis_status['running']
+            if stopped:
+                break
+            
+            # Skip assets already seen earlier in this run (pages can shift
+            # while the library changes), avoiding a redundant DB write
+            new_assets = []
+            for asset in batch:
+                asset_id = asset.get('id')
+                if asset_id not in analyzed_ids:
+                    analyzed_ids.add(asset_id)
+                    new_assets.append(asset)
+            
+            if not new_assets:
+                continue
+            
+            with status_lock:
+                # Prefer the server's count; fall back to a per-page estimate
+                seen = analysis_status['progress'] + len(new_assets)
+                if library_total:
+                    analysis_status['total'] = max(library_total, seen)
+                else:
+                    analysis_status['total'] = analysis_status['progress'] + (len(new_assets) * 10)
+                analysis_status['current_file'] = new_assets[0].get('originalFileName', 'Unknown')
+            
+            # Analyze the whole page at once
+            found = cleaner_engine.analyze_batch(new_assets, scan['id'])
+            
+            with status_lock:
+                analysis_status['found_count'] += found
+                analysis_status['progress'] += len(new_assets)
+        
+        with status_lock:
+            stopped = not analysis_status['running']
+            progress = analysis_status['progress']
+            found_count = analysis_status['found_count']
         
-        logger.info(f"Analysis completed. Analyzed {analysis_status['progress']} assets, found {analysis_status['found_count']} cleanup candidates")
+        # After a full, uninterrupted scan, forget assets that no longer qualify
+        if not stopped:
+            removed = cleaner_engine.prune_stale_candidates(scan)
+            if removed:
+                logger.info(f"Removed {removed} candidates that no longer match")
+        
+        logger.info(f"Analysis completed. Analyzed {progress} assets, found {found_count} cleanup candidates")
         
     except Exception as e:
         logger.error(f"Analysis error: {e}")
-        analysis_status['error'] = str(e)
+        with status_lock:
+            analysis_status['error'] = str(e)
     finally:
-        analysis_status['running'] = False
+        # Persist any candidates still queued from the last batch
+        try:
+            cleaner_engine.flush()
+        except Exception as e:
+            logger.error(f"Error saving candidates: {e}")
+        with status_lock:
+            analysis_status['running'] = False
 
 if __name__ == '__main__':
     # Initialize cleaner engine if config exists
@@ -1,28 +1,214 @@
 import os
+import io
+import json
 import sqlite3
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import csv
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import re
-from pathlib import Path
+import threading
 import logging
+from functools import lru_cache
 
 logger = logging.getLogger(__name__)
 
+# Filename patterns for each cleanup category (matched against the lowercased name)
+SCREENSHOT_PATTERNS = [
+    # Standard screenshot patterns
+    r'screenshot[-_\s]?\d*',
+    r'screen[-_\s]?shot',
+    r'screen[-_\s]?capture',
+    r'scr[-_]?\d+',
+    r'capture[-_]?\d*',
+    
+    # Mobile screenshot patterns
+    r'^img[-_]?\d+[-_]\d+',  # IMG_20210109_095536
+    r'^\d{4}-\d{2}-\d{2}[-_]\d{2}-\d{2}-\d{2}',  # 2021-01-09-09-55-36
+    r'^\d{4}-\d{2}-\d{2}[-_]at[-_]\d{2}\.\d{2}\.\d{2}',  # 2021-01-09 at 09.55.36
+    r'^photo[-_]?\d{4}-\d{2}-\d{2}',  # Photo 2021-01-09
+    
+    # Device-specific patterns
+    r'^img[-_]?\d{8}[-_]\d{6}',  # img_20210109_095536
+    r'^signal-\d{4}-\d{2}-\d{2}',  # Signal screenshots
+    r'^whatsapp[-_]image',  # WhatsApp screenshots
+    r'^telegram[-_]image',  # Telegram screenshots
+    r'^photo_\d{4}-\d{2}-\d{2}',  # Various photo apps
+    r'^pxl_\d{8}_\d{6}',  # Pixel phone pattern
+    
+    # Windows/Desktop patterns
+    r'^snip[-_]?\d*',  # Snipping tool
+    r'^greenshot[-_]',  # Greenshot tool
+    r'^capture\d{4}',  # Generic capture
+    r'^clip[-_]?\d+',  # Clipboard saves
+    
+    # More generic patterns
+    r'[-_]screenshot[-_]',  # Screenshot anywhere in name
+    r'\.screenshot\.',  # .screenshot.
+    r'^ss[-_]?\d+',  # ss_001, SS-123
+    r'^snap[-_]?\d+',  # snap_001
+    r'^grab[-_]?\d+',  # grab_001
+]
+
+WEB_PATTERNS = [
+    'webp$',  # Files ending in webp
+    'cache',
+    'temp[-_]',
+    'tmp[-_]',
+    'download[s]?[-_]?\\d*',
+    '[-_]download',
+    'facebook[-_]',
+    'fb[-_]img',
+    'whatsapp[-_]',
+    'instagram[-_]',
+    'twitter[-_]',
+    'reddit[-_]',
+    'tumblr[-_]',
+    'pinterest[-_]',
+    'messenger[-_]',
+    'discord[-_]',
+    'slack[-_]',
+]
+
+RECOVERY_PATTERNS = [
+    r'^recovered[-_]',
+    r'^found\.\d+',
+    r'^file\d+',
+    r'^copy[-_]?of[-_]',
+    r'\(\d+\)\.',  # Files with (1), (2) etc
+    r'^duplicate[-_]',
+    r'^untitled[-_]?\d*',
+    r'^noname',
+    r'^image\d+',
+    r'^photo\d+',
+    r'^picture\d+',
+    r'^img\d+',
+    r'^dsc[-_]?\d+',
+    r'^dcim[-_]?\d+',
+    r'^burst\d+',  # Burst photo artifacts
+    r'^img_\d{4}$',  # IMG_0001 etc
+]
+
+def _compile_patterns(patterns):
+    """Compile a pattern list into one fused regex plus the individual patterns"""
+    combined = re.compile('|'.join(f'(?:{p})' for p in patterns))
+    return combined, [(p, re.compile(p)) for p in patterns]
+
+def _first_match(filename, matcher):
+    """Return the first pattern (in list order) that matches filename, or None"""
+    combined, compiled = matcher
+    # A single pass over the fused regex rejects the common no-match case
+    if not combined.search(filename):
+        return None
+    for pattern, regex in compiled:
+        if regex.search(filename):
+            return pattern
+    return None
+
+_SCREENSHOT_MATCHER = _compile_patterns(SCREENSHOT_PATTERNS)
+_WEB_MATCHER = _compile_patterns(WEB_PATTERNS)
+_RECOVERY_MATCHER = _compile_patterns(RECOVERY_PATTERNS)
+_ANY_CANDIDATE_RE = _compile_patterns(SCREENSHOT_PATTERNS + WEB_PATTERNS + RECOVERY_PATTERNS)[0]
+
+# Categories in priority order: screenshot beats web file beats recovery artifact
+CATEGORY_MATCHERS = [
+    ('screenshot', _SCREENSHOT_MATCHER),
+    ('web_file', _WEB_MATCHER),
+    ('recovery_artifact', _RECOVERY_MATCHER),
+]
+
+# Distinct filenames remembered by classify_filename (camera names repeat a lot)
+CLASSIFY_CACHE_SIZE = 65536
+
+@lru_cache(maxsize=CLASSIFY_CACHE_SIZE)
+def classify_filename(filename):
+    """Return (category, reason) for a lowercased filename, or None if it is not a candidate"""
+    # Most assets match no category; settle those with one fused pass
+    if not _ANY_CANDIDATE_RE.search(filename):
+        return None
+    
+    # The first category that matches decides
+    for category, matcher in CATEGORY_MATCHERS:
+        pattern = _first_match(filename, matcher)
+        if pattern:
+            return category, f'Filename matches pattern: {pattern}'
+    return None
+
+# Result groups returned by get_results, keyed by their stored category
+RESULT_CATEGORIES = [
+    ('screenshots', 'screenshot'),
+    ('web_files', 'web_file'),
+    ('recovery_artifacts', 'recovery_artifact'),
+]
+
+# Number of queued candidates written per transaction
+CANDIDATE_BATCH_SIZE = 200
+
+# Ids bound per "IN (...)" statement, under SQLite's 999-variable default limit
+SQL_IN_CHUNK_SIZE = 500
+
+# Asset ids sent per curl call in the generated deletion script
+DELETE_SCRIPT_BATCH_SIZE = 200
+
+# Assets requested per Immich search page (the API maximum)
+ASSET_PAGE_SIZE = 1000
+
+# Kept-alive connections held per Immich host
+HTTP_POOL_SIZE = 16
+
+# Transient Immich failures are retried with exponential backoff (0.5s, 1s, 2s...),
+# waiting for Retry-After when the server sends one; the search POST is read-only.
+# DELETE is left out so the destructive bulk delete is only ever sent once
+HTTP_RETRY = Retry(
+    total=4,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=['GET', 'POST'],
+    respect_retry_after_header=True,
+    raise_on_status=False
+)
+
+# Seconds to wait for the library-size probe; it is only a progress hint
+COUNT_TIMEOUT_SECONDS = 5
+
 class ImmichCleaner:
     def __init__(self, base_url, api_key):
         self.base_url = base_url.rstrip('/')
         self.api_key = api_key
         self.db_path = '/data/cleaner.db'
+        self.pending_candidates = []
+        self.db_lock = threading.Lock()
+        self.stats_cache = None  # last get_statistics() result, cleared on every write
+        
+        # Reused across requests so pages are fetched over kept-alive connections
+        self.session = requests.Session()
+        self.session.headers.update({
+            'X-Api-Key': self.api_key,
+            'Content-Type': 'application/json'
+        })
+        adapter = HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE, max_retries=HTTP_RETRY)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        
         self.init_database()
     
     def init_database(self):
         """Initialize SQLite database for storing results"""
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        # One connection is shared by the analysis thread and request handlers,
+        # serialized by db_lock, so its page cache stays warm between calls
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        cursor = self.conn.cursor()
+        
+        # WAL avoids a rollback-journal fsync per commit and lets readers run during writes
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.execute('PRAGMA cache_size=-20000')
+        cursor.execute('PRAGMA mmap_size=268435456')  # read hot pages without read() syscalls
         
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS cleanup_candidates (
@@ -34,308 +220,345 @@ class ImmichCleaner:
                 category TEXT,
                 detection_reason TEXT,
                 marked_for_deletion BOOLEAN DEFAULT 0,
-                analyzed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                analyzed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                scan_id INTEGER
             )
         ''')
         
-        conn.commit()
-        conn.close()
+        # Databases created before scan_id existed get the column added in place
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(cleanup_candidates)')]
+        if 'scan_id' not in columns:
+            cursor.execute('ALTER TABLE cleanup_candidates ADD COLUMN scan_id INTEGER')
+        
+        # Serves the per-category result queries already sorted by date
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_candidates_category_created
+            ON cleanup_candidates (category, created_at DESC)
+        ''')
+        
+        # Partial index over just the (few) rows marked for deletion
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_candidates_marked
+            ON cleanup_candidates (marked_for_deletion)
+            WHERE marked_for_deletion = 1
+        ''')
+        
+        self.conn.commit()
     
-    def analyze_asset(self, asset):
-        """Analyze a single asset to determine if it's a cleanup candidate"""
-        try:
-            filename = asset.get('originalFileName', '').lower()
-            original_path = asset.get('originalPath', '')
-            file_size = asset.get('exifInfo', {}).get('fileSizeInByte', 0)
-            asset_id = asset.get('id', '')
-            created_at = asset.get('fileCreatedAt', '')
-            
-            category = None
-            reason = None
+    def start_scan(self):
+        """Return the state of a new scan: its generation id and whether it reached the last page"""
+        # Every row this scan flags is stamped with a new generation number, so
+        # prune_stale_candidates can tell it apart from rows left by earlier scans
+        with self.db_lock:
+            cursor = self.conn.cursor()
+            cursor.execute('SELECT COALESCE(MAX(scan_id), 0) + 1 FROM cleanup_candidates')
+            scan_id = cursor.fetchone()[0]
+        
+        return {'id': scan_id, 'complete': False}
+    
+    def iter_asset_pages(self, scan):
+        """Yield pages of assets from Immich, fetching the next page in the background"""
+        # The following page is requested as soon as its cursor is known, so
+        # its latency overlaps with the caller analyzing the current page
+        with ThreadPoolExecutor(max_workers=1) as fetcher:
+            pending_page = fetcher.submit(self.fetch_asset_page, 1)
+            page_count = 1
             
-            # Check for screenshots - EXPANDED PATTERNS
-            screenshot_patterns = [
-                # Standard screenshot patterns
-                r'screenshot[-_\s]?\d*',
-                r'screen[-_\s]?shot',
-                r'screen[-_\s]?capture',
-                r'scr[-_]?\d+',
-                r'capture[-_]?\d*',
-                
-                # Mobile screenshot patterns
-                r'^img[-_]?\d+[-_]\d+',  # IMG_20210109_095536
-                r'^\d{4}-\d{2}-\d{2}[-_]\d{2}-\d{2}-\d{2}',  # 2021-01-09-09-55-36
-                r'^\d{4}-\d{2}-\d{2}[-_]at[-_]\d{2}\.\d{2}\.\d{2}',  # 2021-01-09 at 09.55.36
-                r'^photo[-_]?\d{4}-\d{2}-\d{2}',  # Photo 2021-01-09
+            while pending_page:
+                response = pending_page.result()
+                pending_page = None
                 
-                # Device-specific patterns
-                r'^img[-_]?\d{8}[-_]\d{6}',  # img_20210109_095536
-                r'^signal-\d{4}-\d{2}-\d{2}',  # Signal screenshots
-                r'^whatsapp[-_]image',  # WhatsApp screenshots
-                r'^telegram[-_]image',  # Telegram screenshots
-                r'^photo_\d{4}-\d{2}-\d{2}',  # Various photo apps
-                r'^pxl_\d{8}_\d{6}',  # Pixel phone pattern
+                if response.status_code != 200:
+                    logger.error(f"Error fetching page {page_count}: {response.status_code}")
+                    return
                 
-                # Windows/Desktop patterns
-                r'^snip[-_]?\d*',  # Snipping tool
-                r'^greenshot[-_]',  # Greenshot tool
-                r'^capture\d{4}',  # Generic capture
-                r'^clip[-_]?\d+',  # Clipboard saves
+                # Handle the response structure: data.assets.items
+                data = response.json()
+                if 'assets' not in data or 'items' not in data['assets']:
+                    return
                 
-                # More generic patterns
-                r'[-_]screenshot[-_]',  # Screenshot anywhere in name
-                r'\.screenshot\.',  # .screenshot.
-                r'^ss[-_]?\d+',  # ss_001, SS-123
-                r'^snap[-_]?\d+',  # snap_001
-                r'^grab[-_]?\d+',  # grab_001
-            ]
-            
-            for pattern in screenshot_patterns:
-                if re.search(pattern, filename):
-                    category = 'screenshot'
-                    reason = f'Filename matches pattern: {pattern}'
-                    break
-            
-            # Check for web/cache files
-            if not category:
-                web_patterns = [
-                    'webp$',  # Files ending in webp
-                    'cache',
-                    'temp[-_]',
-                    'tmp[-_]',
-                    'download[s]?[-_]?\\d*',
-                    '[-_]download',
-                    'facebook[-_]',
-                    'fb[-_]img',
-                    'whatsapp[-_]',
-                    'instagram[-_]',
-                    'twitter[-_]',
-                    'reddit[-_]',
-                    'tumblr[-_]',
-                    'pinterest[-_]',
-                    'messenger[-_]',
-                    'discord[-_]',
-                    'slack[-_]',
-                ]
+                next_page = data['assets'].get('nextPage')
+                if next_page:
+                    pending_page = fetcher.submit(self.fetch_asset_page, next_page)
+                    page_count += 1
+                else:
+                    scan['complete'] = True
                 
-                for pattern in web_patterns:
-                    if re.search(pattern, filename):
-                        category = 'web_file'
-                        reason = f'Filename matches pattern: {pattern}'
-                        break
+                yield data['assets']['items']
+    
+    def fetch_asset_page(self, page):
+        """Fetch one page of assets from the Immich metadata search"""
+        return self.session.post(
+            f"{self.base_url}/api/search/metadata",
+            json={'page': page, 'size': ASSET_PAGE_SIZE},
+            timeout=30
+        )
+    
+    def count_assets(self):
+        """Ask Immich for the library size, or None if it cannot tell us"""
+        # Sent once without the session's retries so a slow server never delays the scan
+        for endpoint in ('/api/assets/statistics', '/api/asset/statistics'):
+            try:
+                response = requests.get(
+                    f"{self.base_url}{endpoint}",
+                    headers={'X-Api-Key': self.api_key},
+                    timeout=COUNT_TIMEOUT_SECONDS
+                )
+                if response.status_code == 200:
+                    data = response.json()
+                    # Only a hint for progress, so an unexpected body just means "unknown"
+                    if isinstance(data, dict) and isinstance(data.get('total'), int):
+                        return data['total']
+            except (requests.RequestException, ValueError) as e:
+                logger.debug(f"Asset count from {endpoint} failed: {e}")
+        
+        return None
+    
+    def analyze_asset(self, asset, scan_id=None):
+        """Analyze a single asset to determine if it's a cleanup candidate"""
+        try:
+            filename = asset.get('originalFileName', '').lower()
             
-            # Check for recovery artifacts
-            if not category:
-                recovery_patterns = [
-                    r'^recovered[-_]',
-                    r'^found\.\d+',
-                    r'^file\d+',
-                    r'^copy[-_]?of[-_]',
-                    r'\(\d+\)\.',  # Files with (1), (2) etc
-                    r'^duplicate[-_]',
-                    r'^untitled[-_]?\d*',
-                    r'^noname',
-                    r'^image\d+',
-                    r'^photo\d+',
-                    r'^picture\d+',
-                    r'^img\d+',
-                    r'^dsc[-_]?\d+',
-                    r'^dcim[-_]?\d+',
-                    r'^burst\d+',  # Burst photo artifacts
-                    r'^img_\d{4}$',  # IMG_0001 etc
-                ]
-                
-                for pattern in recovery_patterns:
-                    if re.search(pattern, filename):
-                        category = 'recovery_artifact'
-                        reason = f'Filename matches pattern: {pattern}'
-                        break
+            match = classify_filename(filename)
+            if not match:
+                return False
             
-            # If we found a match, save to database
-            if category:
-                self.save_candidate(asset_id, filename, original_path, file_size, 
-                                  created_at, category, reason)
-                return True
+            category, reason = match
+            original_path = asset.get('originalPath', '')
+            file_size = asset.get('exifInfo', {}).get('fileSizeInByte', 0)
+            asset_id = asset.get('id', '')
+            created_at = asset.get('fileCreatedAt', '')
             
-            return False
+            # Save the match to database
+            self.save_candidate(asset_id, filename, original_path, file_size,
+                              created_at, category, reason, scan_id)
+            return True
             
         except Exception as e:
             logger.error(f"Error analyzing asset {asset.get('id', 'unknown')}: {e}")
             return False
     
+    def analyze_batch(self, assets, scan_id=None):
+        """Analyze a batch of assets, saving candidates together; returns how many were found"""
+        found = sum(1 for asset in assets if self.analyze_asset(asset, scan_id))
+        self.flush()
+        return found
+    
     def save_candidate(self, asset_id, filename, original_path, file_size, 
-                      created_at, category, reason):
-        """Save cleanup candidate to database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+                      created_at, category, reason, scan_id=None):
+        """Queue cleanup candidate for saving, flushing once the batch is full"""
+        self.pending_candidates.append((asset_id, filename, original_path, file_size,
+                                        created_at, category, reason, scan_id))
         
-        cursor.execute('''
-            INSERT OR REPLACE INTO cleanup_candidates 
-            (id, filename, original_path, file_size, created_at, category, detection_reason)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (asset_id, filename, original_path, file_size, created_at, category, reason))
-        
-        conn.commit()
-        conn.close()
+        if len(self.pending_candidates) >= CANDIDATE_BATCH_SIZE:
+            self.flush()
     
-    def get_results(self):
-        """Get analysis results from database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def flush(self):
+        """Write queued cleanup candidates to database in a single transaction"""
+        if not self.pending_candidates:
+            return
         
-        results = {
-            'screenshots': [],
-            'web_files': [],
-            'recovery_artifacts': []
-        }
+        with self.db_lock:
+            cursor = self.conn.cursor()
+            cursor.executemany('''
+                INSERT INTO cleanup_candidates 
+                (id, filename, original_path, file_size, created_at, category, detection_reason, scan_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    filename = excluded.filename,
+                    original_path = excluded.original_path,
+                    file_size = excluded.file_size,
+                    created_at = excluded.created_at,
+                    category = excluded.category,
+                    detection_reason = excluded.detection_reason,
+                    analyzed_at = CURRENT_TIMESTAMP,
+                    scan_id = excluded.scan_id
+            ''', self.pending_candidates)
+            
+            self.conn.commit()
+            self.stats_cache = None
+        self.pending_candidates = []
+    
+    def prune_stale_candidates(self, scan):
+        """Drop unmarked candidates the given full scan no longer flagged; returns how many"""
+        if not scan['complete']:
+            return 0
         
-        # Get screenshots
-        cursor.execute('''
-            SELECT id, filename, original_path, file_size, created_at, detection_reason, marked_for_deletion
-            FROM cleanup_candidates
-            WHERE category = 'screenshot'
-            ORDER BY created_at DESC
-        ''')
-        results['screenshots'] = [dict(zip(['id', 'filename', 'path', 'size', 'date', 'reason', 'marked'], row)) 
-                                 for row in cursor.fetchall()]
+        self.flush()
+        with self.db_lock:
+            cursor = self.conn.cursor()
+            
+            # Re-flagged rows were upserted with this scan's id; rows the user
+            # marked for deletion are kept so a mark is never dropped silently
+            cursor.execute('''
+                DELETE FROM cleanup_candidates 
+                WHERE scan_id IS NOT ? AND marked_for_deletion = 0
+            ''', (scan['id'],))
+            removed = cursor.rowcount
+            
+            cursor.execute('''
+                SELECT COUNT(id) FROM cleanup_candidates 
+                WHERE scan_id IS NOT ? AND marked_for_deletion = 1
+            ''', (scan['id'],))
+            kept_marked = cursor.fetchone()[0]
+            
+            self.conn.commit()
+            self.stats_cache = None
         
-        # Get web files
-        cursor.execute('''
-            SELECT id, filename, original_path, file_size, created_at, detection_reason, marked_for_deletion
-            FROM cleanup_candidates
-            WHERE category = 'web_file'
-            ORDER BY created_at DESC
-        ''')
-        results['web_files'] = [dict(zip(['id', 'filename', 'path', 'size', 'date', 'reason', 'marked'], row)) 
-                               for row in cursor.fetchall()]
+        if kept_marked:
+            logger.info(f"Kept {kept_marked} marked candidates the latest scan no longer flagged")
         
-        # Get recovery artifacts
-        cursor.execute('''
-            SELECT id, filename, original_path, file_size, created_at, detection_reason, marked_for_deletion
-            FROM cleanup_candidates
-            WHERE category = 'recovery_artifact'
-            ORDER BY created_at DESC
-        ''')
-        results['recovery_artifacts'] = [dict(zip(['id', 'filename', 'path', 'size', 'date', 'reason', 'marked'], row)) 
-                                        for row in cursor.fetchall()]
+        return removed
+    
+    def get_results(self, limit=None, offset=0):
+        """Get analysis results from database, optionally one page per category"""
+        with self.db_lock:
+            cursor = self.conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            
+            results = {}
+            
+            # Column aliases match the keys the web UI expects
+            for key, category in RESULT_CATEGORIES:
+                cursor.execute('''
+                    SELECT id, filename, original_path AS path, file_size AS size, created_at AS date,
+                           detection_reason AS reason, marked_for_deletion AS marked
+                    FROM cleanup_candidates
+                    WHERE category = ?
+                    ORDER BY created_at DESC
+                    LIMIT ? OFFSET ?
+                ''', (category, -1 if limit is None else limit, offset))
+                results[key] = [dict(row) for row in cursor.fetchall()]
         
-        conn.close()
         return results
     
     def get_statistics(self):
         """Get analysis statistics"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        stats = {}
-        
-        # Total analyzed (this would need to be tracked separately in a real implementation)
-        cursor.execute('SELECT COUNT(DISTINCT id) FROM cleanup_candidates')
-        stats['total_analyzed'] = cursor.fetchone()[0]
-        
-        # Category counts
-        cursor.execute("SELECT COUNT(*) FROM cleanup_candidates WHERE category = 'screenshot'")
-        stats['screenshots_found'] = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM cleanup_candidates WHERE category = 'web_file'")
-        stats['web_files_found'] = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM cleanup_candidates WHERE category = 'recovery_artifact'")
-        stats['recovery_artifacts_found'] = cursor.fetchone()[0]
-        
-        # Total size
-        cursor.execute("SELECT SUM(file_size) FROM cleanup_candidates")
-        total_bytes = cursor.fetchone()[0] or 0
-        stats['total_size_mb'] = round(total_bytes / 1024 / 1024, 2)
-        
-        # Marked for deletion
-        cursor.execute("SELECT COUNT(*) FROM cleanup_candidates WHERE marked_for_deletion = 1")
-        stats['marked_for_deletion'] = cursor.fetchone()[0]
-        
-        conn.close()
-        return stats
+        with self.db_lock:
+            # The UI polls this; reuse the last figures until something is written
+            if self.stats_cache is not None:
+                return dict(self.stats_cache)
+            
+            cursor = self.conn.cursor()
+            
+            # Every figure comes from one scan of the table
+            cursor.execute('''
+                SELECT COUNT(id),
+                       SUM(CASE WHEN category = 'screenshot' THEN 1 ELSE 0 END),
+                       SUM(CASE WHEN category = 'web_file' THEN 1 ELSE 0 END),
+                       SUM(CASE WHEN category = 'recovery_artifact' THEN 1 ELSE 0 END),
+                       SUM(file_size),
+                       SUM(CASE WHEN marked_for_deletion = 1 THEN 1 ELSE 0 END)
+                FROM cleanup_candidates
+            ''')
+            (total_analyzed, screenshots, web_files, recovery_artifacts,
+             total_bytes, marked) = cursor.fetchone()
+            
+            self.stats_cache = {
+                # Total analyzed (this would need to be tracked separately in a real implementation)
+                'total_analyzed': total_analyzed,
+                'screenshots_found': screenshots or 0,
+                'web_files_found': web_files or 0,
+                'recovery_artifacts_found': recovery_artifacts or 0,
+                'total_size_mb': round((total_bytes or 0) / 1024 / 1024, 2),
+                'marked_for_deletion': marked or 0
+            }
+            return dict(self.stats_cache)
     
     def mark_for_deletion(self, asset_ids, mark=True):
         """Mark assets for deletion"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        for asset_id in asset_ids:
-            cursor.execute('''
-                UPDATE cleanup_candidates 
-                SET marked_for_deletion = ? 
-                WHERE id = ?
-            ''', (1 if mark else 0, asset_id))
-        
-        conn.commit()
-        conn.close()
+        with self.db_lock:
+            cursor = self.conn.cursor()
+            
+            marked = 1 if mark else 0
+            # One UPDATE per chunk of ids rather than one per asset
+            for start in range(0, len(asset_ids), SQL_IN_CHUNK_SIZE):
+                chunk = asset_ids[start:start + SQL_IN_CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(f'''
+                    UPDATE cleanup_candidates 
+                    SET marked_for_deletion = ? 
+                    WHERE id IN ({placeholders})
+                ''', [marked, *chunk])
+            
+            self.conn.commit()
+            self.stats_cache = None
     
     def export_to_csv(self):
-        """Export results to CSV file"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        csv_path = '/data/cleanup_results.csv'
-        
-        with open(csv_path, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(['ID', 'Filename', 'Path', 'Size (bytes)', 'Created', 'Category', 'Reason', 'Marked for Deletion'])
+        """Export results as an in-memory CSV file"""
+        with self.db_lock:
+            cursor = self.conn.cursor()
             
-            cursor.execute('''
-                SELECT id, filename, original_path, file_size, created_at, category, detection_reason, marked_for_deletion
-                FROM cleanup_candidates
-                ORDER BY category, created_at DESC
-            ''')
-            
-            for row in cursor.fetchall():
-                writer.writerow(row)
+            with io.StringIO(newline='') as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(['ID', 'Filename', 'Path', 'Size (bytes)', 'Created', 'Category', 'Reason', 'Marked for Deletion'])
+                
+                cursor.execute('''
+                    SELECT id, filename, original_path, file_size, created_at, category, detection_reason, marked_for_deletion
+                    FROM cleanup_candidates
+                    ORDER BY category, created_at DESC
+                ''')
+                
+                # Rows go straight from the cursor to the writer, looped in C
+                writer.writerows(cursor)
+                
+                csv_data = csvfile.getvalue()
         
-        conn.close()
-        return csv_path
+        return io.BytesIO(csv_data.encode('utf-8'))
     
     def generate_deletion_script(self):
-        """Generate a script to delete marked assets"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        script_path = '/data/delete_assets.sh'
-        
-        with open(script_path, 'w') as f:
-            f.write('#!/bin/bash\n\n')
-            f.write('# Immich Asset Deletion Script\n')
-            f.write(f'# Generated on {datetime.now().isoformat()}\n')
-            f.write(f'# API URL: {self.base_url}\n\n')
-            f.write('# This script will delete the marked assets via Immich API\n\n')
-            
-            cursor.execute('''
-                SELECT id, filename 
-                FROM cleanup_candidates 
-                WHERE marked_for_deletion = 1
-            ''')
+        """Generate an in-memory script to delete marked assets"""
+        with self.db_lock:
+            cursor = self.conn.cursor()
             
-            for asset_id, filename in cursor.fetchall():
-                f.write(f'# Deleting: {filename}\n')
-                f.write(f'curl -X DELETE "{self.base_url}/api/asset" \\\n')
-                f.write(f'  -H "X-Api-Key: {self.api_key}" \\\n')
-                f.write(f'  -H "Content-Type: application/json" \\\n')
-                f.write(f'  -d \'{{"ids":["{asset_id}"],"force":true}}\'\n\n')
-        
-        # Make script executable
-        os.chmod(script_path, 0o755)
+            with io.StringIO() as f:
+                f.writelines([
+                    '#!/bin/bash\n\n',
+                    '# Immich Asset Deletion Script\n',
+                    f'# Generated on {datetime.now().isoformat()}\n',
+                    f'# API URL: {self.base_url}\n\n',
+                    '# This script will delete the marked assets via Immich API\n\n'
+                ])
+                
+                cursor.execute('''
+                    SELECT id, filename 
+                    FROM cleanup_candidates 
+                    WHERE marked_for_deletion = 1
+                ''')
+                
+                marked = cursor.fetchall()
+                
+                # Every call is identical apart from its ids, so format this part once
+                curl_prefix = (
+                    f'curl -X DELETE "{self.base_url}/api/asset" \\\n'
+                    f'  -H "X-Api-Key: {self.api_key}" \\\n'
+                    f'  -H "Content-Type: application/json" \\\n'
+                )
+                
+                # The bulk endpoint takes a list of ids, so one call covers a whole batch
+                for start in range(0, len(marked), DELETE_SCRIPT_BATCH_SIZE):
+                    batch = marked[start:start + DELETE_SCRIPT_BATCH_SIZE]
+                    f.writelines(f'# Deleting: {filename}\n' for _, filename in batch)
+                    ids_json = json.dumps([asset_id for asset_id, _ in batch])
+                    f.write(f'{curl_prefix}  -d \'{{"ids":{ids_json},"force":true}}\'\n\n')
+                
+                script = f.getvalue()
         
-        conn.close()
-        return script_path
+        return io.BytesIO(script.encode('utf-8'))
     
     def remove_deleted_assets(self, asset_ids):
         """Remove deleted assets from database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        placeholders = ','.join('?' * len(asset_ids))
-        cursor.execute(f'''
-            DELETE FROM cleanup_candidates 
-            WHERE id IN ({placeholders})
-        ''', asset_ids)
-        
-        conn.commit()
-        conn.close()
+        with self.db_lock:
+            cursor = self.conn.cursor()
+            
+            # Chunked so large selections stay within SQLite's bound-variable limit
+            for start in range(0, len(asset_ids), SQL_IN_CHUNK_SIZE):
+                chunk = asset_ids[start:start + SQL_IN_CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(f'''
+                    DELETE FROM cleanup_candidates 
+                    WHERE id IN ({placeholders})
+                ''', chunk)
+            
+            self.conn.commit()
+            self.stats_cache = None